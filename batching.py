@@ -0,0 +1,105 @@
+"""
+Batching and chunking helpers for Spleeter separators
+
+Spleeter splits the STFT of its input into segments of T frames and runs
+the U-Net on each segment independently. Aligning inputs and chunks on
+that segment grid lets several inputs share a forward pass, and long
+inputs be processed chunk by chunk, without any segment seeing audio
+from two different inputs.
+"""
+
+import numpy as np
+
+
+def to_stereo(waveform):
+    """Convert a waveform to two channels (same rule as Spleeter's convertor)"""
+    if waveform.shape[1] == 1:
+        return np.repeat(waveform, 2, axis=-1)
+    return waveform[:, :2]
+
+
+def get_segment_length(separator):
+    """Number of samples covered by one U-Net segment of a separator"""
+    params = separator._params
+    return params['T'] * params['frame_step']
+
+
+def get_chunk_stride(chunk_length, overlap, segment_length):
+    """
+    Distance between the starts of consecutive chunks
+
+    Chunks advance by a whole number of segments and by at least one, so
+    the chunk length is rounded down to the segment grid, and up to one
+    segment when shorter.
+    """
+    return max(segment_length, (chunk_length - overlap) // segment_length * segment_length)
+
+
+def separate_chunked(separator, waveform, chunk_length, overlap):
+    """
+    Separate a waveform chunk by chunk to bound peak memory
+
+    Chunks start on the segment grid and advance by a whole number of
+    segments, so every segment a chunk sees is also a segment of the
+    full waveform. Consecutive chunks overlap by `overlap` samples that
+    are blended with complementary Hann fades, which only sum to one when
+    no more than two chunks overlap, hence `overlap` may not exceed the
+    stride.
+    """
+    stride = get_chunk_stride(chunk_length, overlap, get_segment_length(separator))
+    if overlap > stride:
+        raise ValueError(f'Chunk overlap ({overlap} samples) exceeds the chunk stride ({stride} samples)')
+    if len(waveform) <= stride + overlap:
+        return separator.separate(waveform)
+
+    fade_in = (np.sin(np.linspace(0, np.pi / 2, overlap)) ** 2).astype(np.float32)[:, None]
+    fade_out = 1 - fade_in
+
+    prediction = {}
+    start = 0
+    while True:
+        end = min(start + stride + overlap, len(waveform))
+        for stem_name, data in separator.separate(waveform[start:end]).items():
+            if stem_name not in prediction:
+                prediction[stem_name] = np.zeros((len(waveform), data.shape[1]), dtype=np.float32)
+            if overlap and start > 0:
+                data[:overlap] *= fade_in
+            if overlap and end < len(waveform):
+                data[-overlap:] *= fade_out
+            prediction[stem_name][start:end] += data
+        if end == len(waveform):
+            return prediction
+        start += stride
+
+
+def separate_batch(separator, waveforms, chunk_length, overlap):
+    """
+    Separate several waveforms in a single pass
+
+    Waveforms are laid end to end, each one padded to a whole number of
+    segments with at least one STFT frame of silence, so that no U-Net
+    segment or STFT frame mixes two inputs. This also holds when the
+    concatenation is long enough to be chunked, since chunks stay on the
+    segment grid.
+    """
+    params = separator._params
+    segment_length = get_segment_length(separator)
+
+    padded = []
+    offsets = []
+    position = 0
+    for waveform in waveforms:
+        if waveform.shape[-1] != 2:
+            waveform = to_stereo(waveform)
+        length = len(waveform)
+        padded_length = -(-(length + params['frame_length']) // segment_length) * segment_length
+        padded.append(np.pad(waveform, ((0, padded_length - length), (0, 0))))
+        offsets.append((position, length))
+        position += padded_length
+
+    prediction = separate_chunked(separator, np.concatenate(padded), chunk_length, overlap)
+
+    return [
+        {stem_name: data[start:start + length] for stem_name, data in prediction.items()}
+        for start, length in offsets
+    ]
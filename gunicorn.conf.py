@@ -0,0 +1,18 @@
+"""Gunicorn settings for the Spleeter API"""
+
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# A single worker: models are loaded once per process and inference is
+# serialized by the in-process job queue
+worker_class = 'gthread'
+workers = 1
+
+# Every /separate request holds a thread while its job waits in the queue
+# (up to JOB_TIMEOUT), so keep this well above MAX_BATCH or queued jobs
+# starve /health, /download and /cleanup
+threads = int(os.environ.get('GUNICORN_THREADS', '64'))
+
+# Disabled since model preloading and separation can be slow
+timeout = 0
@@ -4,16 +4,55 @@ Spleeter API Service
 A lightweight Flask API for audio source separation using Spleeter
 """
 
+import errno
+import hashlib
+import json
 import os
+import queue
 import shutil
-from pathlib import Path
-from flask import Flask, request, jsonify, send_file
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from functools import lru_cache
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+import numpy as np
+
+# Grow GPU memory on demand. TensorFlow has a single allocator per GPU for the
+# whole process, shared by every Separator's session, and the first session
+# sizes it from Spleeter's fixed per_process_gpu_memory_fraction (70%); allow
+# growth stops it from grabbing that share up front.
+os.environ.setdefault('TF_FORCE_GPU_ALLOW_GROWTH', 'true')
+
+# Inference precision (fp32, fp16 or bf16), must be set before TensorFlow loads
+INFERENCE_PRECISION = os.environ.get('INFERENCE_PRECISION', 'fp32').lower()
+if INFERENCE_PRECISION == 'fp16':
+    # Graph rewrite to float16 on GPUs with Tensor Cores
+    os.environ.setdefault('TF_ENABLE_AUTO_MIXED_PRECISION', '1')
+elif INFERENCE_PRECISION == 'bf16':
+    # oneDNN bfloat16 math on CPUs with AVX-512 BF16 / AMX
+    os.environ.setdefault('TF_ENABLE_ONEDNN_OPTS', '1')
+    os.environ.setdefault('ONEDNN_DEFAULT_FPMATH_MODE', 'BF16')
+
+# Compile the separation graph with XLA (set XLA_JIT=1 to enable). XLA compiles
+# once per input shape: the startup warm-up only covers its own dummy input, so
+# the first request of every new (padded) length pays the compilation cost.
+# Batched inputs are padded to whole model segments and long inputs are cut
+# into fixed size chunks, which keeps the number of distinct shapes small.
+XLA_JIT = os.environ.get('XLA_JIT', '0') == '1'
+if XLA_JIT:
+    os.environ.setdefault('TF_XLA_FLAGS', '--tf_xla_auto_jit=2 --tf_xla_cpu_global_jit')
+
 from spleeter.separator import Separator
+from spleeter.audio.adapter import AudioAdapter
 import uuid
 import logging
 
+from batching import get_chunk_stride, separate_batch
+from stem_cache import MANIFEST_FILENAME, StemCache
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -23,22 +62,126 @@ CORS(app)
 
 # Configuration
 UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', '/app/uploads')
+SCRATCH_FOLDER = os.environ.get('SCRATCH_FOLDER', '/dev/shm/spleeter_uploads')
 OUTPUT_FOLDER = os.environ.get('OUTPUT_FOLDER', '/app/outputs')
+# Must be on the same filesystem as OUTPUT_FOLDER, cache entries are hard links
+CACHE_FOLDER = os.environ.get('CACHE_FOLDER', os.path.join(OUTPUT_FOLDER, '.cache'))
 MAX_CONTENT_LENGTH = 100 * 1024 * 1024  # 100MB max file size
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
+# When served behind nginx, hand downloads off with X-Accel-Redirect, e.g.
+#   location /internal_stems/ { internal; alias /app/outputs/; sendfile on; tcp_nopush on; }
+# with ACCEL_REDIRECT_PREFIX=/internal_stems/
+ACCEL_REDIRECT_PREFIX = os.environ.get('ACCEL_REDIRECT_PREFIX')
+
 # Ensure directories exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+# Uploads are only read once, so keep them in RAM (tmpfs) when available
+try:
+    os.makedirs(SCRATCH_FOLDER, exist_ok=True)
+except OSError:
+    SCRATCH_FOLDER = None
+
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'mp3', 'wav', 'flac', 'ogg', 'm4a', 'wma'}
 
-# Initialize Spleeter separators (lazy loading)
+# Bytes of an upload inspected with ffprobe before it is saved
+MAX_PROBE_BYTES = 1 << 20
+
+# Size of the chunks an upload is written and hashed in
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Longest accepted input (in seconds)
+MAX_DURATION = int(os.environ.get('MAX_DURATION', '3600'))
+
+# Available Spleeter models
+AVAILABLE_MODELS = ['spleeter:2stems', 'spleeter:4stems', 'spleeter:5stems']
+
+# Load and warm up all models at startup (set PRELOAD_MODELS=0 to disable)
+PRELOAD_MODELS = os.environ.get('PRELOAD_MODELS', '1') == '1'
+
+# Maximum time (in seconds) a request waits for its separation job
+JOB_TIMEOUT = int(os.environ.get('JOB_TIMEOUT', '600'))
+
+# Maximum number of queued jobs merged into a single forward pass
+MAX_BATCH = int(os.environ.get('MAX_BATCH', '8'))
+
+# Maximum total audio duration (in seconds) of a batch, longer jobs run alone
+MAX_BATCH_SECONDS = int(os.environ.get('MAX_BATCH_SECONDS', '60'))
+
+# Time (in milliseconds) the worker waits for more jobs to fill a batch
+MAX_BATCH_WAIT_MS = int(os.environ.get('MAX_BATCH_WAIT_MS', '50'))
+
+# Sample rate expected by the pretrained Spleeter models
+SAMPLE_RATE = 44100
+
+# Samples covered by one U-Net segment of the pretrained models (T * frame_step, ~11.9s)
+SEGMENT_LENGTH = 512 * 1024
+
+# Long inputs are separated in chunks of about this length (in seconds), rounded
+# down to whole model segments, so it must be at least one segment long ...
+CHUNK_SECONDS = int(os.environ.get('CHUNK_SECONDS', '30'))
+
+# ... overlapping by this much (in seconds) to crossfade chunk boundaries, at
+# most the distance between chunk starts (the rounded chunk length minus overlap)
+CHUNK_OVERLAP_SECONDS = float(os.environ.get('CHUNK_OVERLAP_SECONDS', '1'))
+
+CHUNK_LENGTH = CHUNK_SECONDS * SAMPLE_RATE
+CHUNK_OVERLAP = int(CHUNK_OVERLAP_SECONDS * SAMPLE_RATE)
+CHUNK_STRIDE = get_chunk_stride(CHUNK_LENGTH, CHUNK_OVERLAP, SEGMENT_LENGTH)
+if CHUNK_LENGTH < SEGMENT_LENGTH:
+    raise ValueError(f'CHUNK_SECONDS must be at least one model segment ({SEGMENT_LENGTH / SAMPLE_RATE:.1f}s)')
+if not 0 <= CHUNK_OVERLAP <= CHUNK_STRIDE:
+    raise ValueError(f'CHUNK_OVERLAP_SECONDS must be in [0, {CHUNK_STRIDE / SAMPLE_RATE:.1f}] (the chunk stride)')
+
+# Settings that change the separated output, part of every cache key
+CACHE_SETTINGS = f'{INFERENCE_PRECISION}-xla{int(XLA_JIT)}-chunk{CHUNK_SECONDS}-{CHUNK_OVERLAP_SECONDS}'
+
+# Pin inference and stem encoding to disjoint CPU sets (set CPU_PINNING=1 to
+# enable). Helps under sustained mixed load, but a lone job then encodes on
+# ENCODE_CPU_COUNT CPUs only (default: a quarter of the CPUs, at least one).
+CPU_PINNING = os.environ.get('CPU_PINNING', '0') == '1'
+if CPU_PINNING and not hasattr(os, 'sched_setaffinity'):
+    logger.warning("CPU_PINNING is not supported on this platform, ignoring it")
+    CPU_PINNING = False
+INFERENCE_CPUS = ENCODE_CPUS = None
+if CPU_PINNING:
+    AVAILABLE_CPUS = sorted(os.sched_getaffinity(0))
+    ENCODE_CPU_COUNT = int(os.environ.get('ENCODE_CPU_COUNT', str(max(1, len(AVAILABLE_CPUS) // 4))))
+    if not 0 < ENCODE_CPU_COUNT < len(AVAILABLE_CPUS):
+        raise ValueError(
+            f'CPU_PINNING needs ENCODE_CPU_COUNT in [1, {len(AVAILABLE_CPUS) - 1}] '
+            f'({len(AVAILABLE_CPUS)} CPUs available)'
+        )
+    ENCODE_CPUS = set(AVAILABLE_CPUS[-ENCODE_CPU_COUNT:])
+    INFERENCE_CPUS = set(AVAILABLE_CPUS) - ENCODE_CPUS
+
+# Spleeter separators by model, preloaded at startup (created on first use
+# with PRELOAD_MODELS=0)
 separators = {}
+separators_lock = threading.Lock()
+
+# Stems of previously separated inputs, deleted with the last job using them
+stem_cache = StemCache(CACHE_FOLDER, CACHE_SETTINGS)
+
+# Shared audio adapter (ffmpeg based) used to decode inputs
+audio_adapter = AudioAdapter.default()
+
+# Thread pool used to encode stems in parallel (one ffmpeg process per stem),
+# ffmpeg processes inherit the CPU affinity of the thread that starts them
+encode_executor = ThreadPoolExecutor(
+    max_workers=len(ENCODE_CPUS) if ENCODE_CPUS else os.cpu_count() or 1,
+    initializer=lambda: pin_current_thread(ENCODE_CPUS)
+)
+
+# Pending separation jobs, consumed by the single separation worker (Spleeter
+# separators are not thread safe, so the models only ever run on one thread)
+job_queue = queue.Queue()
 
 
 def allowed_file(filename):
@@ -46,12 +189,248 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def valid_job_id(job_id):
+    """Check that a job ID is a UUID, so it can only name a job directory"""
+    try:
+        return str(uuid.UUID(job_id)) == job_id
+    except ValueError:
+        return False
+
+
+def probe_upload(file):
+    """
+    Check the head of an upload with ffprobe, returning an error message if invalid
+
+    Only positive evidence rejects an upload: streams were found but none
+    is audio, or the header reports a duration that is too long. Anything
+    the probe cannot parse from the first bytes (large cover art or
+    metadata blocks, index at the end of the file, ...) is left to the
+    decoder.
+    """
+    head = file.stream.read(MAX_PROBE_BYTES)
+    file.stream.seek(0)
+
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error',
+             '-show_entries', 'format=duration:stream=codec_type,sample_rate,duration',
+             '-of', 'json', 'pipe:0'],
+            input=head,
+            capture_output=True,
+            timeout=2
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        # Leave the decision to the decoder if the probe itself could not run
+        logger.warning(f"Could not probe upload: {str(e)}")
+        return None
+
+    if result.returncode != 0:
+        return None
+
+    info = json.loads(result.stdout or '{}')
+    streams = info.get('streams', [])
+    audio_streams = [s for s in streams if s.get('codec_type') == 'audio']
+    if not audio_streams:
+        return 'No audio stream found' if streams else None
+
+    # Duration is only known when the container header carries it
+    duration = info.get('format', {}).get('duration') or audio_streams[0].get('duration')
+    if duration not in (None, 'N/A') and float(duration) > MAX_DURATION:
+        return f'Audio too long. Maximum duration: {MAX_DURATION}s'
+
+    return None
+
+
+def get_upload_folder(content_length):
+    """
+    Pick the RAM backed scratch folder if the upload fits, else the disk
+
+    The free space check is not a reservation, save_upload falls back to
+    the disk when concurrent uploads fill the scratch folder anyway.
+    """
+    if SCRATCH_FOLDER and content_length:
+        if shutil.disk_usage(SCRATCH_FOLDER).free > 2 * content_length:
+            return SCRATCH_FOLDER
+    return UPLOAD_FOLDER
+
+
+def write_upload(file, path):
+    """Write an upload to a path, returning the SHA-256 digest of its content"""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'wb') as f:
+            for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        # Do not leave partial uploads behind
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return digest.hexdigest()
+
+
+def save_upload(file, filename, content_length):
+    """Save an upload, returning its path and the SHA-256 digest of its content"""
+    upload_folder = get_upload_folder(content_length)
+    path = os.path.join(upload_folder, filename)
+    try:
+        return path, write_upload(file, path)
+    except OSError as e:
+        if e.errno != errno.ENOSPC or upload_folder == UPLOAD_FOLDER:
+            raise
+        # Concurrent uploads filled the scratch folder, fall back to disk
+        logger.warning(f"Scratch folder full, saving {filename} to {UPLOAD_FOLDER}")
+        file.stream.seek(0)
+        path = os.path.join(UPLOAD_FOLDER, filename)
+        return path, write_upload(file, path)
+
+
 def get_separator(model='spleeter:4stems'):
     """Get or create a Spleeter separator instance"""
-    if model not in separators:
-        logger.info(f"Initializing Spleeter model: {model}")
-        separators[model] = Separator(model)
-    return separators[model]
+    with separators_lock:
+        if model not in separators:
+            logger.info(f"Initializing Spleeter model: {model}")
+            separators[model] = Separator(model)
+        return separators[model]
+
+
+def pin_current_thread(cpus):
+    """Restrict the calling thread (and threads/processes it starts) to the given CPUs"""
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+
+def preload_models():
+    """Load every model and run a dummy separation to warm it up"""
+    # TensorFlow sizes and pins its thread pools after the thread creating them
+    previous_cpus = os.sched_getaffinity(0) if INFERENCE_CPUS else None
+    pin_current_thread(INFERENCE_CPUS)
+    try:
+        for model in AVAILABLE_MODELS:
+            separator = get_separator(model)
+            logger.info(f"Warming up Spleeter model: {model}")
+            separator.separate(np.zeros((16384, 2), dtype=np.float32))
+    finally:
+        pin_current_thread(previous_cpus)
+
+
+def encode_stem(data, stem_path, output_format):
+    """Encode a stem by piping its raw float32 PCM straight into ffmpeg"""
+    command = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'f32le', '-ar', str(SAMPLE_RATE), '-ac', str(data.shape[1]), '-i', 'pipe:0'
+    ]
+    if output_format == 'mp3':
+        command += ['-c:a', 'libmp3lame', '-b:a', '320k']
+    command.append(stem_path)
+
+    # Hand ffmpeg the array's own buffer, no copy unless it is not float32 already
+    pcm = np.ascontiguousarray(data, dtype='<f4')
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = process.communicate(memoryview(pcm).cast('B'))
+    if process.returncode != 0:
+        raise Exception(f"Error encoding {os.path.basename(stem_path)}: {stderr.decode(errors='replace').strip()}")
+
+
+def encode_stems(prediction, output_dir, output_format):
+    """Encode separated stems to disk in parallel, returning their paths"""
+    stem_paths = {}
+    futures = []
+    for stem_name, data in prediction.items():
+        stem_path = os.path.join(output_dir, f'{stem_name}.{output_format}')
+        stem_paths[stem_name] = stem_path
+        futures.append(encode_executor.submit(encode_stem, data, stem_path, output_format))
+
+    # Wait for every encode so that failures surface to the caller
+    for future in futures:
+        future.result()
+
+    return stem_paths
+
+
+def write_manifest(job_output_dir, stem_paths):
+    """Write the stem name -> stem filename mapping of a job"""
+    manifest = {stem_name: os.path.basename(stem_path) for stem_name, stem_path in stem_paths.items()}
+    with open(os.path.join(job_output_dir, MANIFEST_FILENAME), 'w') as f:
+        json.dump(manifest, f)
+
+
+@lru_cache(maxsize=1024)
+def load_manifest(job_id):
+    """Load the stem manifest of a job (cached, jobs are immutable once written)"""
+    with open(os.path.join(OUTPUT_FOLDER, job_id, MANIFEST_FILENAME)) as f:
+        return json.load(f)
+
+
+def separation_worker():
+    """Run queued separation jobs, batching jobs that use the same model"""
+    pin_current_thread(INFERENCE_CPUS)
+    pending = []
+    while True:
+        if not pending:
+            pending.append(job_queue.get())
+
+        # Give other requests a short window to join the batch
+        deadline = time.monotonic() + MAX_BATCH_WAIT_MS / 1000
+        while len(pending) < MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(job_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        # Coalesce short jobs of the first job's model, up to MAX_BATCH_SECONDS of audio
+        model = pending[0][0]
+        batch = [pending[0]]
+        batch_length = len(pending[0][1])
+        remaining_jobs = []
+        for job in pending[1:]:
+            if job[0] == model and batch_length + len(job[1]) <= MAX_BATCH_SECONDS * SAMPLE_RATE:
+                batch.append(job)
+                batch_length += len(job[1])
+            else:
+                remaining_jobs.append(job)
+        pending = remaining_jobs
+
+        # Skip jobs whose request already gave up
+        jobs = [job for job in batch if job[2].set_running_or_notify_cancel()]
+        if jobs:
+            try:
+                predictions = separate_batch(
+                    get_separator(model),
+                    [waveform for _, waveform, _ in jobs],
+                    CHUNK_LENGTH,
+                    CHUNK_OVERLAP
+                )
+                for (_, _, future), prediction in zip(jobs, predictions):
+                    future.set_result(prediction)
+            except Exception as e:
+                for _, _, future in jobs:
+                    future.set_exception(e)
+
+        for _ in batch:
+            job_queue.task_done()
+
+
+def separate_waveform(model, waveform):
+    """Queue a waveform for separation and wait for the predicted stems"""
+    future = Future()
+    job_queue.put((model, waveform, future))
+    try:
+        return future.result(timeout=JOB_TIMEOUT)
+    except TimeoutError:
+        # Drop the job if it has not started yet
+        future.cancel()
+        raise Exception(f"Separation timed out after {JOB_TIMEOUT}s")
+
+
+if PRELOAD_MODELS:
+    preload_models()
+
+threading.Thread(target=separation_worker, daemon=True).start()
 
 
 @app.route('/health', methods=['GET'])
@@ -116,14 +495,18 @@ def separate_audio():
     output_format = request.form.get('format', 'mp3').lower()
     
     # Validate model
-    valid_models = ['spleeter:2stems', 'spleeter:4stems', 'spleeter:5stems']
-    if model not in valid_models:
-        return jsonify({'error': f'Invalid model. Choose from: {valid_models}'}), 400
+    if model not in AVAILABLE_MODELS:
+        return jsonify({'error': f'Invalid model. Choose from: {AVAILABLE_MODELS}'}), 400
     
     # Validate format
     if output_format not in ['mp3', 'wav']:
         return jsonify({'error': 'Invalid format. Choose mp3 or wav'}), 400
     
+    # Reject uploads that are clearly not usable audio before saving them
+    probe_error = probe_upload(file)
+    if probe_error:
+        return jsonify({'error': probe_error}), 400
+    
     # Generate unique job ID
     job_id = str(uuid.uuid4())
     input_path = None
@@ -132,50 +515,42 @@ def separate_audio():
     try:
         # Save uploaded file
         filename = secure_filename(file.filename)
-        input_path = os.path.join(UPLOAD_FOLDER, f"{job_id}_{filename}")
-        file.save(input_path)
+        input_path, content_hash = save_upload(file, f"{job_id}_{filename}", request.content_length)
         
         logger.info(f"Processing file: {filename} with model: {model}")
         
         # Create output directory for this job
         os.makedirs(job_output_dir, exist_ok=True)
         
-        # Get separator
-        separator = get_separator(model)
-        
-        # Perform separation
-        separator.separate_to_file(
-            input_path,
-            job_output_dir,
-            codec=output_format,
-            bitrate='320k' if output_format == 'mp3' else None
-        )
-        
-        # Find the output directory
-        base_name = Path(filename).stem
-        stem_dir = os.path.join(job_output_dir, base_name)
-        
-        if not os.path.exists(stem_dir):
-            raise Exception(f"Output directory not found: {stem_dir}")
-        
+        cache_dir = stem_cache.get_entry_dir(content_hash, model, output_format)
+        stem_paths = stem_cache.restore(cache_dir, job_output_dir)
+        if stem_paths:
+            # Same input already separated with this model, format and settings
+            logger.info(f"Reusing cached stems for: {filename}")
+            os.remove(input_path)
+        else:
+            # Decode the input once and queue it for in-memory separation
+            waveform, _ = audio_adapter.load(input_path, sample_rate=SAMPLE_RATE)
+            os.remove(input_path)
+            prediction = separate_waveform(model, waveform)
+
+            # Encode all stems in parallel
+            stem_paths = encode_stems(prediction, job_output_dir, output_format)
+
+            # Record the stems so downloads can find them without scanning
+            write_manifest(job_output_dir, stem_paths)
+            stem_cache.store(cache_dir, job_output_dir, stem_paths)
+
         # List all generated stems
         stems = []
-        for stem_file in os.listdir(stem_dir):
-            if stem_file.endswith(f'.{output_format}'):
-                stem_name = stem_file.replace(f'.{output_format}', '')
-                stem_path = os.path.join(stem_dir, stem_file)
-                
-                stems.append({
-                    'name': stem_name,
-                    'filename': stem_file,
-                    'path': stem_path,
-                    'size': os.path.getsize(stem_path),
-                    'download_url': f'/download/{job_id}/{stem_name}'
-                })
-        
-        # Clean up input file
-        if input_path and os.path.exists(input_path):
-            os.remove(input_path)
+        for stem_name, stem_path in stem_paths.items():
+            stems.append({
+                'name': stem_name,
+                'filename': os.path.basename(stem_path),
+                'path': stem_path,
+                'size': os.path.getsize(stem_path),
+                'download_url': f'/download/{job_id}/{stem_name}'
+            })
         
         logger.info(f"Separation completed. Job ID: {job_id}, Stems: {len(stems)}")
         
@@ -195,7 +570,7 @@ def separate_audio():
         if input_path and os.path.exists(input_path):
             os.remove(input_path)
         if os.path.exists(job_output_dir):
-            shutil.rmtree(job_output_dir)
+            stem_cache.remove_job(job_output_dir)
         
         return jsonify({
             'status': 'error',
@@ -207,35 +582,55 @@ def separate_audio():
 def download_stem(job_id, stem_name):
     """Download a specific stem"""
     
+    if not valid_job_id(job_id):
+        return jsonify({'error': 'Job not found'}), 404
+    
     job_output_dir = os.path.join(OUTPUT_FOLDER, job_id)
     
     if not os.path.exists(job_output_dir):
         return jsonify({'error': 'Job not found'}), 404
     
-    for root, dirs, files in os.walk(job_output_dir):
-        for file in files:
-            if file.startswith(stem_name) and (file.endswith('.mp3') or file.endswith('.wav')):
-                file_path = os.path.join(root, file)
-                return send_file(
-                    file_path,
-                    as_attachment=True,
-                    download_name=file
-                )
+    try:
+        manifest = load_manifest(job_id)
+    except (OSError, ValueError):
+        return jsonify({'error': 'Job not found'}), 404
     
-    return jsonify({'error': 'Stem not found'}), 404
+    if stem_name not in manifest:
+        return jsonify({'error': 'Stem not found'}), 404
+    
+    stem_file = manifest[stem_name]
+    
+    # Let nginx send the file with sendfile(2), bypassing Python entirely
+    if ACCEL_REDIRECT_PREFIX:
+        response = Response()
+        response.headers['X-Accel-Redirect'] = f"{ACCEL_REDIRECT_PREFIX.rstrip('/')}/{job_id}/{stem_file}"
+        response.headers['Content-Disposition'] = f'attachment; filename={stem_file}'
+        # Let nginx pick the content type from the file extension
+        del response.headers['Content-Type']
+        return response
+    
+    # Otherwise send_file uses the server's wsgi.file_wrapper (sendfile) when available
+    return send_file(
+        os.path.join(job_output_dir, stem_file),
+        as_attachment=True,
+        download_name=stem_file
+    )
 
 
 @app.route('/cleanup/<job_id>', methods=['DELETE'])
 def cleanup_job(job_id):
     """Clean up job files"""
     
+    if not valid_job_id(job_id):
+        return jsonify({'error': 'Job not found'}), 404
+    
     job_output_dir = os.path.join(OUTPUT_FOLDER, job_id)
     
     if not os.path.exists(job_output_dir):
         return jsonify({'error': 'Job not found'}), 404
     
     try:
-        shutil.rmtree(job_output_dir)
+        stem_cache.remove_job(job_output_dir)
         logger.info(f"Cleaned up job: {job_id}")
         return jsonify({
             'status': 'success',
@@ -267,6 +662,7 @@ def index():
 
 
 if __name__ == '__main__':
+    # Development server only, the Docker image serves the app with gunicorn
     app.run(
         host='0.0.0.0',
         port=5000,
@@ -0,0 +1,142 @@
+"""
+Content addressed cache of separated stems
+
+Cache entries hold hard links to the stem files of the jobs that produced
+or reused them, so an entry costs no extra disk space while those jobs
+exist, and it is deleted together with the last job linking to it. The
+cache must therefore live on the same filesystem as the job outputs;
+when it does not, nothing is cached.
+"""
+
+import errno
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Name of the per-job file mapping stem names to stem files
+MANIFEST_FILENAME = 'manifest.json'
+
+# Name of the per-job file pointing at the cache entry its stems are linked to
+CACHE_ENTRY_FILENAME = 'cache_entry'
+
+
+def link_files(source_dir, target_dir, filenames):
+    """Hard link files into another directory, undoing partial work on failure"""
+    linked = []
+    try:
+        for filename in filenames:
+            target = os.path.join(target_dir, filename)
+            os.link(os.path.join(source_dir, filename), target)
+            linked.append(target)
+    except OSError:
+        for target in linked:
+            os.remove(target)
+        raise
+
+
+class StemCache:
+    """Stems of previously separated inputs, keyed by content hash, model, settings and format"""
+
+    def __init__(self, cache_folder, settings):
+        self.cache_folder = cache_folder
+        self.settings = settings
+        # Serializes lookups, insertions and releases
+        self.lock = threading.Lock()
+        self.link_warning_logged = False
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def get_entry_dir(self, content_hash, model, output_format):
+        """Cache directory holding the stems of an input for a model, format and settings"""
+        return os.path.join(
+            self.cache_folder, content_hash, f"{model.split(':', 1)[1]}-{self.settings}", output_format
+        )
+
+    def _link_or_skip(self, source_dir, target_dir, filenames):
+        """Link files for the cache, returning False if they live on another filesystem"""
+        try:
+            link_files(source_dir, target_dir, filenames)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM):
+                raise
+            if not self.link_warning_logged:
+                logger.warning(
+                    f"Cannot hard link between {self.cache_folder} and the job outputs "
+                    f"({str(e)}), stem caching is disabled"
+                )
+                self.link_warning_logged = True
+            return False
+        return True
+
+    def _write_entry_reference(self, job_output_dir, entry_dir):
+        with open(os.path.join(job_output_dir, CACHE_ENTRY_FILENAME), 'w') as f:
+            f.write(entry_dir)
+
+    def restore(self, entry_dir, job_output_dir):
+        """Populate a job from cached stems, returning their paths (None on a cache miss)"""
+        with self.lock:
+            if not os.path.isdir(entry_dir):
+                return None
+            with open(os.path.join(entry_dir, MANIFEST_FILENAME)) as f:
+                manifest = json.load(f)
+            if not self._link_or_skip(entry_dir, job_output_dir, list(manifest.values()) + [MANIFEST_FILENAME]):
+                return None
+            self._write_entry_reference(job_output_dir, entry_dir)
+        return {stem_name: os.path.join(job_output_dir, stem_file) for stem_name, stem_file in manifest.items()}
+
+    def store(self, entry_dir, job_output_dir, stem_paths):
+        """Add the stems of a finished job to the cache"""
+        # Build the entry aside and rename it so readers never see a partial one
+        staging_dir = f'{entry_dir}.{uuid.uuid4()}.tmp'
+        filenames = [os.path.basename(stem_path) for stem_path in stem_paths.values()]
+        with self.lock:
+            try:
+                os.makedirs(staging_dir)
+                if not self._link_or_skip(job_output_dir, staging_dir, filenames + [MANIFEST_FILENAME]):
+                    shutil.rmtree(staging_dir, ignore_errors=True)
+                    self._prune_parents(entry_dir)
+                    return
+                os.rename(staging_dir, entry_dir)
+                self._write_entry_reference(job_output_dir, entry_dir)
+            except OSError as e:
+                # Most likely another job cached the same input first
+                logger.warning(f"Could not cache stems in {entry_dir}: {str(e)}")
+                shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def _prune_parents(self, entry_dir):
+        """Drop the model and content hash directories of an entry once empty"""
+        for directory in (os.path.dirname(entry_dir), os.path.dirname(os.path.dirname(entry_dir))):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+
+    def release(self, entry_dir):
+        """Delete a cache entry once no job links to its stems anymore"""
+        with self.lock:
+            try:
+                with open(os.path.join(entry_dir, MANIFEST_FILENAME)) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                return
+            # Stems have a single link left when only the cache holds them
+            if any(os.stat(os.path.join(entry_dir, stem_file)).st_nlink > 1 for stem_file in manifest.values()):
+                return
+            shutil.rmtree(entry_dir)
+            self._prune_parents(entry_dir)
+
+    def remove_job(self, job_output_dir):
+        """Delete a job's files, and its cache entry if no other job uses it"""
+        entry_dir = None
+        try:
+            with open(os.path.join(job_output_dir, CACHE_ENTRY_FILENAME)) as f:
+                entry_dir = f.read()
+        except OSError:
+            pass
+        shutil.rmtree(job_output_dir)
+        if entry_dir:
+            self.release(entry_dir)
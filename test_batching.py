@@ -0,0 +1,103 @@
+"""Tests for the batching and chunking helpers"""
+
+import numpy as np
+import pytest
+
+from batching import get_chunk_stride, get_segment_length, separate_batch, separate_chunked
+
+SAMPLE_RATE = 44100
+CHUNK_LENGTH = 30 * SAMPLE_RATE
+OVERLAP = 1 * SAMPLE_RATE
+
+
+class SegmentSeparator:
+    """
+    Fake separator mimicking Spleeter's segmentation
+
+    The input is front padded with one STFT frame and cut into segments of
+    T frames; every output sample of a segment is the peak amplitude of
+    all the samples that segment's frames see, so any mixing between two
+    inputs shows up as non-zero output.
+    """
+
+    _params = {'T': 512, 'frame_step': 1024, 'frame_length': 4096}
+
+    def separate(self, waveform):
+        frame_length = self._params['frame_length']
+        segment_length = self._params['T'] * self._params['frame_step']
+        padded = np.concatenate([
+            np.zeros((frame_length, 2), dtype=np.float32),
+            waveform,
+            np.zeros((segment_length + frame_length, 2), dtype=np.float32)
+        ])
+        output = np.zeros_like(padded)
+        for start in range(0, frame_length + len(waveform), segment_length):
+            output[start:start + segment_length] = np.abs(padded[start:start + segment_length + frame_length]).max()
+        return {'vocals': output[frame_length:frame_length + len(waveform)]}
+
+
+class IdentitySeparator:
+    """Fake separator returning its input as the only stem"""
+
+    _params = SegmentSeparator._params
+
+    def separate(self, waveform):
+        return {'vocals': waveform.copy()}
+
+
+def test_batched_jobs_do_not_leak_into_each_other():
+    loud = np.ones((int(29.5 * SAMPLE_RATE), 2), dtype=np.float32)
+    silent = np.zeros((20 * SAMPLE_RATE, 2), dtype=np.float32)
+
+    predictions = separate_batch(SegmentSeparator(), [loud, silent], CHUNK_LENGTH, OVERLAP)
+
+    assert predictions[1]['vocals'].shape == silent.shape
+    assert not predictions[1]['vocals'].any()
+    assert predictions[0]['vocals'].all()
+
+
+def test_batch_preserves_order_and_lengths():
+    waveforms = [
+        np.random.rand(1000, 2).astype(np.float32),
+        np.random.rand(600000, 1).astype(np.float32),
+    ]
+
+    predictions = separate_batch(IdentitySeparator(), waveforms, CHUNK_LENGTH, OVERLAP)
+
+    np.testing.assert_allclose(predictions[0]['vocals'], waveforms[0])
+    np.testing.assert_allclose(predictions[1]['vocals'], np.repeat(waveforms[1], 2, axis=1), atol=1e-5)
+
+
+def test_chunked_crossfade_reconstructs_input():
+    waveform = np.random.rand(95 * SAMPLE_RATE, 2).astype(np.float32)
+
+    prediction = separate_chunked(IdentitySeparator(), waveform, CHUNK_LENGTH, OVERLAP)
+
+    np.testing.assert_allclose(prediction['vocals'], waveform, atol=1e-5)
+
+
+def test_chunked_crossfade_with_overlap_as_long_as_stride():
+    segment_length = get_segment_length(IdentitySeparator())
+    waveform = np.random.rand(5 * segment_length, 2).astype(np.float32)
+
+    prediction = separate_chunked(IdentitySeparator(), waveform, 2 * segment_length, segment_length)
+
+    np.testing.assert_allclose(prediction['vocals'], waveform, atol=1e-5)
+
+
+def test_chunked_rejects_overlap_longer_than_stride():
+    segment_length = get_segment_length(IdentitySeparator())
+    waveform = np.random.rand(5 * segment_length, 2).astype(np.float32)
+    overlap = segment_length + 1
+
+    assert get_chunk_stride(CHUNK_LENGTH, overlap, segment_length) == segment_length
+    with pytest.raises(ValueError):
+        separate_chunked(IdentitySeparator(), waveform, CHUNK_LENGTH, overlap)
+
+
+def test_chunked_without_overlap():
+    waveform = np.random.rand(95 * SAMPLE_RATE, 2).astype(np.float32)
+
+    prediction = separate_chunked(IdentitySeparator(), waveform, CHUNK_LENGTH, 0)
+
+    np.testing.assert_allclose(prediction['vocals'], waveform)
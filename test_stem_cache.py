@@ -0,0 +1,94 @@
+"""Tests for the stem cache"""
+
+import errno
+import json
+import logging
+import os
+
+import stem_cache
+from stem_cache import CACHE_ENTRY_FILENAME, MANIFEST_FILENAME, StemCache
+
+MANIFEST = {'vocals': 'vocals.mp3', 'accompaniment': 'accompaniment.mp3'}
+
+
+def make_job(output_folder, job_id):
+    """Create a finished job directory with stems and a manifest"""
+    job_output_dir = os.path.join(output_folder, job_id)
+    os.makedirs(job_output_dir)
+    for stem_file in MANIFEST.values():
+        with open(os.path.join(job_output_dir, stem_file), 'w') as f:
+            f.write(stem_file)
+    with open(os.path.join(job_output_dir, MANIFEST_FILENAME), 'w') as f:
+        json.dump(MANIFEST, f)
+    return job_output_dir, {
+        stem_name: os.path.join(job_output_dir, stem_file) for stem_name, stem_file in MANIFEST.items()
+    }
+
+
+def test_entry_lives_until_last_job_is_removed(tmp_path):
+    cache = StemCache(str(tmp_path / 'cache'), 'fp32')
+    entry_dir = cache.get_entry_dir('abc123', 'spleeter:2stems', 'mp3')
+    job_a, stem_paths = make_job(tmp_path, 'a')
+    cache.store(entry_dir, job_a, stem_paths)
+
+    job_b = str(tmp_path / 'b')
+    os.makedirs(job_b)
+    restored = cache.restore(entry_dir, job_b)
+
+    assert restored == {stem_name: os.path.join(job_b, stem_file) for stem_name, stem_file in MANIFEST.items()}
+    with open(restored['vocals']) as f:
+        assert f.read() == 'vocals.mp3'
+
+    cache.remove_job(job_a)
+    assert not os.path.exists(job_a)
+    assert os.path.isdir(entry_dir)
+
+    cache.remove_job(job_b)
+    assert not os.path.exists(entry_dir)
+    assert os.listdir(tmp_path / 'cache') == []
+
+
+def test_concurrent_store_keeps_first_entry(tmp_path):
+    cache = StemCache(str(tmp_path / 'cache'), 'fp32')
+    entry_dir = cache.get_entry_dir('abc123', 'spleeter:2stems', 'mp3')
+    job_a, stem_paths_a = make_job(tmp_path, 'a')
+    job_b, stem_paths_b = make_job(tmp_path, 'b')
+
+    cache.store(entry_dir, job_a, stem_paths_a)
+    cache.store(entry_dir, job_b, stem_paths_b)
+
+    assert os.path.exists(os.path.join(job_a, CACHE_ENTRY_FILENAME))
+    assert not os.path.exists(os.path.join(job_b, CACHE_ENTRY_FILENAME))
+    assert sorted(os.listdir(os.path.dirname(entry_dir))) == ['mp3']
+
+    # The job that lost the race owns its stems outright
+    cache.remove_job(job_b)
+    assert os.path.isdir(entry_dir)
+    cache.remove_job(job_a)
+    assert not os.path.exists(entry_dir)
+
+
+def test_cross_device_disables_caching(tmp_path, monkeypatch, caplog):
+    cache = StemCache(str(tmp_path / 'cache'), 'fp32')
+    entry_dir = cache.get_entry_dir('abc123', 'spleeter:2stems', 'mp3')
+    job_a, stem_paths = make_job(tmp_path, 'a')
+    os.makedirs(entry_dir)
+    with open(os.path.join(entry_dir, MANIFEST_FILENAME), 'w') as f:
+        json.dump(MANIFEST, f)
+
+    def link(source, target):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    monkeypatch.setattr(stem_cache.os, 'link', link)
+
+    job_b = str(tmp_path / 'b')
+    os.makedirs(job_b)
+    with caplog.at_level(logging.WARNING, logger='stem_cache'):
+        assert cache.restore(entry_dir, job_b) is None
+        other_entry_dir = cache.get_entry_dir('def456', 'spleeter:2stems', 'mp3')
+        cache.store(other_entry_dir, job_a, stem_paths)
+
+    assert os.listdir(job_b) == []
+    assert not os.path.exists(os.path.join(job_a, CACHE_ENTRY_FILENAME))
+    assert not os.path.exists(os.path.dirname(os.path.dirname(other_entry_dir)))
+    assert len(caplog.records) == 1